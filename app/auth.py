@@ -1,25 +1,64 @@
-from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
 from typing import Optional, Annotated
 
 from fastapi import APIRouter, Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
-from jose import jwt, JWTError
-from passlib.context import CryptContext
 from pydantic import BaseModel
+import base64
+import bcrypt
+import hashlib
+import json
+import jwt
 import os
+import ssl
+import threading
+import time
+
+# bcrypt cost factor (2^rounds key-schedule iterations per hash/verify).
+# 10 keeps dev logins fast; do not go below 10 in production.
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "10"))
 
 # simple in-memory user store for demo/marking
-# username -> { "username": str, "password_hash": str, "role": "user"|"admin" }
-_pwd = CryptContext(schemes=["bcrypt"], deprecated="auto")
-_users = {
-    "alice": {"username": "alice", "password_hash": _pwd.hash("password1"), "role": "user"},
-    "admin": {"username": "admin", "password_hash": _pwd.hash("admin123"), "role": "admin"},
-}
+# username -> { "username": str, "password_hash": bytes, "role": "user"|"admin" }
+# hashes are kept as bytes so bcrypt.checkpw needs no per-call encode
+_users = {}
+# checked against for unknown usernames so login costs one bcrypt either way;
+# made by seed_users, or on first use if a login comes in before startup
+_dummy_hash: Optional[bytes] = None
+
+def _get_dummy_hash() -> bytes:
+    global _dummy_hash
+    if _dummy_hash is None:
+        _dummy_hash = bcrypt.hashpw(b"dummy", bcrypt.gensalt(BCRYPT_ROUNDS))
+    return _dummy_hash
+
+def seed_users():
+    # called from the app startup event so importing this module stays cheap
+    if _users:
+        return
+    _get_dummy_hash()
+    for username, password, role in (
+        ("alice", b"password1", "user"),
+        ("admin", b"admin123", "admin"),
+    ):
+        _users[username] = {
+            "username": username,
+            "password_hash": bcrypt.hashpw(password, bcrypt.gensalt(BCRYPT_ROUNDS)),
+            "role": role,
+        }
 
 SECRET_KEY = os.getenv("SECRET_KEY", "dev-secret-change-me")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 60
 
+# verified tokens are cached so repeat requests skip the HMAC check
+TOKEN_CACHE_TTL = 60
+TOKEN_CACHE_SIZE = 4096
+# raw token -> (monotonic expiry, User)
+_token_cache: "OrderedDict[str, tuple[float, User]]" = OrderedDict()
+# get_current_user is a sync dependency, so it runs on threadpool workers
+_token_cache_lock = threading.Lock()
+
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="/auth/login")
 router = APIRouter(prefix="/auth", tags=["auth"])
 
@@ -33,17 +72,26 @@ class User(BaseModel):
 
 def _authenticate(username: str, password: str) -> Optional[User]:
     u = _users.get(username)
-    if not u or not _pwd.verify(password, u["password_hash"]):
+    ok = bcrypt.checkpw(password.encode("utf-8"), u["password_hash"] if u else _get_dummy_hash())
+    if not u or not ok:
         return None
     return User(username=u["username"], role=u["role"])
 
+def hmac_backend() -> str:
+    # PyJWT signs HS256 via hmac + hashlib.sha256; when hashlib.sha256 is the
+    # OpenSSL constructor, hmac hands the whole MAC to OpenSSL's EVP code
+    # (SHA-NI where the CPU has it) instead of the builtin _sha256 fallback.
+    if hashlib.sha256.__module__ == "_hashlib":
+        return f"openssl ({ssl.OPENSSL_VERSION})"
+    return "builtin"
+
 def _create_token(user: User, minutes: int = ACCESS_TOKEN_EXPIRE_MINUTES) -> str:
-    now = datetime.now(tz=timezone.utc)
+    now = int(time.time())
     payload = {
         "sub": user.username,
         "role": user.role,
-        "iat": int(now.timestamp()),
-        "exp": int((now + timedelta(minutes=minutes)).timestamp()),
+        "iat": now,
+        "exp": now + minutes * 60,
     }
     return jwt.encode(payload, SECRET_KEY, algorithm=ALGORITHM)
 
@@ -55,19 +103,64 @@ def login(form: Annotated[OAuth2PasswordRequestForm, Depends()]):
     token = _create_token(user)
     return Token(access_token=token)
 
+def _cached_user(token: str) -> Optional[User]:
+    with _token_cache_lock:
+        hit = _token_cache.get(token)
+        if hit is None:
+            return None
+        expires_at, user = hit
+        if expires_at <= time.monotonic():
+            _token_cache.pop(token, None)
+            return None
+        _token_cache.move_to_end(token)
+        return user
+
+def _cache_user(token: str, exp: int, user: User) -> None:
+    ttl = min(exp - time.time(), TOKEN_CACHE_TTL)
+    if ttl <= 0:
+        return
+    with _token_cache_lock:
+        _token_cache[token] = (time.monotonic() + ttl, user)
+        _token_cache.move_to_end(token)
+        while len(_token_cache) > TOKEN_CACHE_SIZE:
+            _token_cache.popitem(last=False)
+
+def _token_alg(token: str) -> Optional[str]:
+    # peek at the unverified header; binascii.Error and JSON errors are ValueErrors
+    header = token.split(".", 1)[0]
+    try:
+        return json.loads(base64.urlsafe_b64decode(header + "=" * (-len(header) % 4))).get("alg")
+    except (ValueError, AttributeError):
+        return None
+
 def get_current_user(token: Annotated[str, Depends(oauth2_scheme)]) -> User:
+    user = _cached_user(token)
+    if user is not None:
+        return user
+    # cheap structural checks before the full decode: a JWS compact token is
+    # always header.payload.signature, and we only ever issue HS256
+    if token.count(".") != 2 or _token_alg(token) != ALGORITHM:
+        raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid token")
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        payload = jwt.decode(
+            token,
+            SECRET_KEY,
+            algorithms=[ALGORITHM],
+            options={"require": ["exp", "sub"], "verify_aud": False},
+        )
         username = payload.get("sub")
         role = payload.get("role")
         if not username or not role:
-            raise JWTError("missing claims")
+            raise jwt.InvalidTokenError("missing claims")
         u = _users.get(username)
         if not u:
-            raise JWTError("user not found")
-        return User(username=username, role=role)
-    except JWTError:
+            raise jwt.InvalidTokenError("user not found")
+        user = User(username=username, role=role)
+    except jwt.InvalidTokenError:
         raise HTTPException(status_code=status.HTTP_401_UNAUTHORIZED, detail="invalid token")
+    # only successful verifications are cached
+    _cache_user(token, payload["exp"], user)
+    return user
 
 def require_role(required: str):
     def checker(user: Annotated[User, Depends(get_current_user)]) -> User:
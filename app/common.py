@@ -0,0 +1,60 @@
+# app/common.py
+# storage paths and helpers shared by main.py and the routers
+import os
+
+import numpy as np, cv2
+from fastapi import HTTPException
+from fastapi.responses import Response
+
+from app.db import SessionLocal
+
+DATA_DIR = os.getenv("DATA_DIR", "/data")
+UPLOADS = os.path.join(DATA_DIR, "uploads")
+PROCESSED = os.path.join(DATA_DIR, "processed")
+os.makedirs(UPLOADS, exist_ok=True)
+os.makedirs(PROCESSED, exist_ok=True)
+
+def get_db():
+    db = SessionLocal()
+    try:
+        yield db
+    finally:
+        db.close()
+
+def write_bytes(path: str, data: bytes) -> None:
+    with open(path, "wb") as f:
+        f.write(data)
+
+# /images/jobs and /external/random ops; both only need luma, so callers
+# decode straight to grayscale (IMREAD_GRAYSCALE skips the RGB buffer)
+EDGE_LOW, EDGE_HIGH = 80, 160
+
+def apply_op(gray: np.ndarray, op: str) -> tuple[np.ndarray, list]:
+    # op is "grayscale" or "edge"; returns the output and its PNG encoder params
+    if op == "grayscale":
+        return gray, [cv2.IMWRITE_PNG_COMPRESSION, 1]
+    edges = cv2.Canny(gray, EDGE_LOW, EDGE_HIGH, L2gradient=True)
+    # binary map: max deflate is cheap on it and shrinks the file a lot
+    return edges, [cv2.IMWRITE_PNG_COMPRESSION, 9]
+
+def image_response(data: bytes, media_type: str, ext: str) -> Response:
+    # the encoded image is already one buffer: send it in a single body with a
+    # Content-Length (a StreamingResponse over BytesIO iterates it line by line)
+    return Response(
+        data,
+        media_type=media_type,
+        headers={"Content-Disposition": f'inline; filename="output{ext}"'}
+    )
+
+# fmt -> (extension, encoder params); PNG at zlib level 1, lossy WebP at q85
+_ENCODERS = {
+    "png": (".png", [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+    "webp": (".webp", [cv2.IMWRITE_WEBP_QUALITY, 85]),
+}
+
+def array_response(arr: np.ndarray, fmt: str = "png") -> Response:
+    ext, params = _ENCODERS[fmt]
+    ok, enc = cv2.imencode(ext, arr, params)
+    if not ok:
+        raise HTTPException(status_code=500, detail=f"{fmt.upper()} encode failed")
+    return image_response(enc.tobytes(), f"image/{fmt}", ext)
@@ -1,15 +1,19 @@
 # app/data_store.py
 from datetime import datetime, timedelta
 
-IMAGES = []
+_KINDS = ("original", "grayscale", "edge")
+_STATUSES = ("ready", "processing", "failed")
+
 base = datetime.utcnow() - timedelta(days=2)
 
-for i in range(1, 51):
-    IMAGES.append({
+IMAGES = [
+    {
         "id": i,
         "owner": "alice" if i % 2 else "bob",
         "filename": f"img_{i}.png",
-        "kind": ["original", "grayscale", "edge"][i % 3],
-        "status": ["ready", "processing", "failed"][i % 3],
+        "kind": _KINDS[i % 3],
+        "status": _STATUSES[i % 3],
         "created_at": base + timedelta(minutes=i * 7),
-    })
+    }
+    for i in range(1, 51)
+]
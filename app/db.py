@@ -1,7 +1,8 @@
 # app/db.py
-import os
-from sqlalchemy import create_engine
+import os, uuid
+from sqlalchemy import create_engine, event, inspect, text, String
 from sqlalchemy.orm import sessionmaker, declarative_base
+from sqlalchemy.pool import QueuePool, StaticPool
 
 Base = declarative_base()
 
@@ -22,12 +23,86 @@ def _resolve_db_url():
             os.makedirs(parent, exist_ok=True)
     return url
 
+def _pool_args(url):
+    if not url.startswith("sqlite"):
+        return {}
+    if url in ("sqlite://", "sqlite:///:memory:"):
+        # an in-memory DB only exists on its one connection
+        return {"poolclass": StaticPool}
+    # keep connections (and their pragmas/page cache) open across requests
+    return {"poolclass": QueuePool, "pool_size": 10, "max_overflow": 20}
+
 DATABASE_URL = _resolve_db_url()
 engine = create_engine(
     DATABASE_URL,
-    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {}
+    connect_args={"check_same_thread": False} if DATABASE_URL.startswith("sqlite") else {},
+    **_pool_args(DATABASE_URL),
 )
+if DATABASE_URL.startswith("sqlite"):
+    @event.listens_for(engine, "connect")
+    def _sqlite_pragmas(dbapi_conn, _record):
+        # WAL lets readers proceed while log/job writes commit
+        cur = dbapi_conn.cursor()
+        cur.execute("PRAGMA journal_mode=WAL")
+        cur.execute("PRAGMA synchronous=NORMAL")
+        cur.execute("PRAGMA temp_store=MEMORY")
+        cur.execute("PRAGMA cache_size=-65536")  # 64 MiB
+        cur.close()
+
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# job ids used to be stored as 36-char strings; they are now 16-byte UUIDs
+# (see models.BinaryUUID). (table, column) pairs holding a job id:
+_JOB_ID_COLUMNS = (("image_jobs", "id"), ("processing_logs", "job_id"))
+# SQLite user_version once string job ids have been converted
+_JOB_IDS_MIGRATED = 1
+
+def _migrate_job_ids(conn):
+    if conn.dialect.name == "sqlite":
+        # the conversion scans both tables, so it runs once per database
+        if conn.execute(text("PRAGMA user_version")).scalar() >= _JOB_IDS_MIGRATED:
+            return
+        tables = set(inspect(conn).get_table_names())
+        for table, col in _JOB_ID_COLUMNS:
+            if table not in tables:
+                continue
+            # SQLite keeps the old VARCHAR declaration but stores blobs in it
+            # as-is, so converting the values is enough
+            old = conn.execute(text(
+                f"SELECT DISTINCT {col} FROM {table} WHERE typeof({col}) = 'text'"
+            )).scalars().all()
+            try:
+                params = [{"new": uuid.UUID(v).bytes, "old": v} for v in old]
+            except ValueError as e:
+                raise RuntimeError(f"{table}.{col} holds a value that is not a UUID: {e}")
+            if params:
+                conn.execute(text(f"UPDATE {table} SET {col} = :new WHERE {col} = :old"), params)
+        conn.execute(text(f"PRAGMA user_version = {_JOB_IDS_MIGRATED}"))
+        return
+
+    # elsewhere (including PostgreSQL, which now expects a native uuid column)
+    # a string column has to be converted by hand; fail here rather than on
+    # the first query
+    insp = inspect(conn)
+    tables = set(insp.get_table_names())
+    for table, col in _JOB_ID_COLUMNS:
+        if table not in tables:
+            continue
+        ctype = next(c["type"] for c in insp.get_columns(table) if c["name"] == col)
+        if isinstance(ctype, String):
+            raise RuntimeError(
+                f"{table}.{col} is still {ctype}; job ids are now stored as "
+                f"uuid/BINARY(16), convert the column before starting the app"
+            )
+
 def init_db():
     Base.metadata.create_all(bind=engine)
+    # create_all skips tables that already exist, including their indexes,
+    # so indexes added since a DB was created are created here
+    for table in Base.metadata.sorted_tables:
+        for idx in table.indexes:
+            idx.create(bind=engine, checkfirst=True)
+    with engine.begin() as conn:
+        # replaced by ix_processing_logs_action_timestamp
+        conn.execute(text("DROP INDEX IF EXISTS ix_processing_logs_action"))
+        _migrate_job_ids(conn)
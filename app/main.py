@@ -1,23 +1,28 @@
 # app/main.py
-from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Depends
-from fastapi.responses import StreamingResponse, FileResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, Depends, Request, BackgroundTasks
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import FileResponse, Response, ORJSONResponse
 from fastapi.staticfiles import StaticFiles
 from pathlib import Path
 from typing import Optional
 from io import BytesIO
-from PIL import Image, ImageFilter, UnidentifiedImageError
-import os, shutil, time, hashlib, secrets
+from PIL import Image, UnidentifiedImageError, features as pil_features
+import PIL
+import os, time, hashlib, secrets, logging, asyncio, uuid
 
 import numpy as np, cv2
+import httpx
 from sqlalchemy import inspect, text
 from sqlalchemy.orm import Session
 
 # --- App first ---
-app = FastAPI(title="Image Processing API")
+app = FastAPI(title="Image Processing API", default_response_class=ORJSONResponse)
+logger = logging.getLogger("uvicorn.error")
 
 # --- Routers (import after app is created) ---
-from app.auth import verify_token, router as auth_router, get_current_user, require_role, User
+from app.auth import verify_token, router as auth_router, get_current_user, require_role, seed_users, hmac_backend, User
 from app.db import init_db, engine, SessionLocal
+from app.common import get_db, write_bytes, apply_op, array_response, UPLOADS, PROCESSED
 from app.models import ImageJob, JobStatus, ProcessingLog
 from app.routers.images import router as images_router
 from app.routers.external import router as external_router
@@ -32,9 +37,32 @@ if _client_dir.exists():
     app.mount("/client", StaticFiles(directory=str(_client_dir), html=True), name="client")
 
 # --- Startup / Admin DB ---
+@app.on_event("startup")
+async def _open_http_client():
+    # one pooled client for the external router so connections (and TLS
+    # sessions) to picsum/qrserver are kept alive between requests
+    app.state.http = httpx.AsyncClient(
+        follow_redirects=True,
+        timeout=20.0,
+        limits=httpx.Limits(max_connections=64, max_keepalive_connections=16),
+    )
+
+@app.on_event("shutdown")
+async def _close_http_client():
+    await app.state.http.aclose()
+
 @app.on_event("startup")
 def on_startup():
     init_db()
+    seed_users()
+    logger.info("JWT HMAC backend: %s", hmac_backend())
+    # OpenCV sizes its parallel_for_ pool to every core in each worker process;
+    # split the cores between uvicorn workers so they don't oversubscribe
+    cv2.setUseOptimized(True)
+    workers = max(1, int(os.getenv("UVICORN_WORKERS", "1")))
+    cv2.setNumThreads(max(1, (os.cpu_count() or 1) // workers))
+    logger.info("OpenCV: %d threads, optimized=%s", cv2.getNumThreads(), cv2.useOptimized())
+    logger.info("Pillow %s (libjpeg-turbo: %s)", PIL.__version__, pil_features.check_feature("libjpeg_turbo"))
 
 @app.post("/admin/initdb")
 def admin_initdb():
@@ -58,62 +86,137 @@ def admin_dbcheck():
     except Exception as e2:
         return {"error": "dbcheck failed", "inspector_error": err1 if 'err1' in locals() else None, "sqlite_error": str(e2)}
 
-# --- Paths / DB session ---
-DATA_DIR = os.getenv("DATA_DIR", "/data")
-UPLOADS = os.path.join(DATA_DIR, "uploads")
-PROCESSED = os.path.join(DATA_DIR, "processed")
-os.makedirs(UPLOADS, exist_ok=True)
-os.makedirs(PROCESSED, exist_ok=True)
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
 # --- Log helper ---
-def log_action(db: Session, user_id: str, job_id: str, action: str, details: dict = None):
-    log = ProcessingLog(
+# logs are queued and written in batches by a background task, so requests
+# don't pay a commit (and fsync) per log row
+LOG_BATCH_SIZE = 64
+LOG_FLUSH_INTERVAL = 0.5  # seconds
+# created by _start_log_writer on the running loop (a Queue is bound to the
+# loop that first waits on it); None on it tells the writer to flush and exit
+_log_q: "Optional[asyncio.Queue[Optional[ProcessingLog]]]" = None
+_log_task: Optional[asyncio.Task] = None
+
+def log_action(user_id: str, job_id: str, action: str, details: dict = None):
+    # must be called from the event loop (asyncio.Queue is not thread-safe)
+    row = ProcessingLog(
         user_id=user_id,
         job_id=job_id,
         action=action,
         details=details or {}
     )
-    db.add(log)
-    db.commit()
-    db.refresh(log)
-    return log
+    if _log_task is None or _log_task.done():
+        # no writer running (app not started, or it died): write it directly
+        _write_logs([row])
+        return
+    _log_q.put_nowait(row)
+
+def _write_logs(rows: list) -> None:
+    with SessionLocal() as db:
+        db.bulk_save_objects(rows)
+        db.commit()
+
+async def _drain_logs(q: asyncio.Queue):
+    loop = asyncio.get_running_loop()
+    stopping = False
+    while not stopping:
+        row = await q.get()
+        if row is None:
+            break
+        rows = [row]
+        deadline = loop.time() + LOG_FLUSH_INTERVAL
+        while len(rows) < LOG_BATCH_SIZE:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(q.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stopping = True
+                break
+            rows.append(row)
+        try:
+            await run_in_threadpool(_write_logs, rows)
+        except Exception:
+            logger.exception("failed to write %d processing logs", len(rows))
+
+def _log_writer_done(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        logger.error("processing log writer stopped", exc_info=task.exception())
+
+@app.on_event("startup")
+async def _start_log_writer():
+    global _log_q, _log_task
+    _log_q = asyncio.Queue()
+    _log_task = asyncio.create_task(_drain_logs(_log_q))
+    _log_task.add_done_callback(_log_writer_done)
+
+@app.on_event("shutdown")
+async def _stop_log_writer():
+    # not cancelled: the writer may be holding a batch it hasn't written yet,
+    # so it is asked to finish and awaited instead (a failure has already
+    # been logged by _log_writer_done)
+    global _log_q, _log_task
+    if _log_task:
+        if not _log_task.done():
+            _log_q.put_nowait(None)
+        await asyncio.wait([_log_task])
+    _log_q = _log_task = None
 
 # --- Health / Helpers ---
 @app.get("/health")
 def health():
     return {"status": "ok"}
 
-def to_stream(img: Image.Image, fmt: str = "PNG") -> StreamingResponse:
-    buf = BytesIO()
-    img.save(buf, format=fmt)
-    buf.seek(0)
-    return StreamingResponse(
-        buf,
-        media_type="image/png",
-        headers={"Content-Disposition": 'inline; filename="output.png"'}
-    )
-
-def open_image_or_400(file: UploadFile) -> Image.Image:
-    try:
-        img = Image.open(file.file)
-        img.load()
-        return img
-    except UnidentifiedImageError:
-        raise HTTPException(status_code=400, detail="Invalid image file")
+# uploads are held in memory while processing, so cap their size
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(20 * 1024 * 1024)))
+# leading bytes of PNG, JPEG and GIF (WebP is RIFF....WEBP, checked separately)
+_IMAGE_MAGIC = (b"\x89PNG", b"\xff\xd8\xff", b"GIF8")
+
+async def read_image_upload(file: UploadFile) -> bytes:
+    # reject oversized or non-image uploads from the first 12 bytes, before
+    # reading the whole file and handing it to a decoder
+    if file.size is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(413, f"Upload larger than {MAX_UPLOAD_BYTES} bytes")
+    head = await file.read(12)
+    if not (head.startswith(_IMAGE_MAGIC) or (head[:4] == b"RIFF" and head[8:12] == b"WEBP")):
+        raise HTTPException(415, "Upload is not a PNG, JPEG, WebP or GIF image")
+    await file.seek(0)
+    return await file.read()
+
+def decode_or_400(data: bytes) -> np.ndarray:
+    src = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+    if src is None:
+        raise HTTPException(400, "Invalid image file")
+    return src
 
 # == Simple image endpoints ==
+# decode/filter/encode is blocking, so each endpoint hands it to the threadpool
+def _grayscale(data: bytes, fmt: str) -> Response:
+    gray = cv2.cvtColor(decode_or_400(data), cv2.COLOR_BGR2GRAY)
+    return array_response(gray, fmt)
+
 @app.post("/images/grayscale")
-async def grayscale(file: UploadFile = File(...), current=Depends(verify_token)):
-    img = open_image_or_400(file).convert("RGB")
-    gray = img.convert("L")
-    return to_stream(gray, "PNG")
+async def grayscale(
+    file: UploadFile = File(...),
+    fmt: str = Query("png", pattern="^(png|webp)$"),
+    current=Depends(verify_token),
+):
+    data = await read_image_upload(file)
+    return await run_in_threadpool(_grayscale, data, fmt)
+
+def _resize(data: bytes, w: int, h: int, fmt: str) -> Response:
+    src = decode_or_400(data)
+    h0, w0 = src.shape[:2]
+    if (w0, h0) == (w, h):
+        resized = src
+    elif w <= w0 and h <= h0:
+        # downscale: area averaging doesn't alias and has SIMD paths
+        resized = cv2.resize(src, (w, h), interpolation=cv2.INTER_AREA)
+    else:
+        resized = cv2.resize(src, (w, h), interpolation=cv2.INTER_LINEAR)
+    return array_response(resized, fmt)
 
 @app.post("/images/resize")
 async def resize(
@@ -121,10 +224,27 @@ async def resize(
     w: int = Query(..., gt=0, le=8000),
     h: int = Query(..., gt=0, le=8000),
     file: UploadFile = File(...),
+    fmt: str = Query("png", pattern="^(png|webp)$"),
 ):
-    img = open_image_or_400(file).convert("RGB")
-    resized = img.resize((w, h))
-    return to_stream(resized, "PNG")
+    data = await read_image_upload(file)
+    return await run_in_threadpool(_resize, data, w, h, fmt)
+
+def _edges(data: bytes, ksize: int, sigma: float, low: int, high: int, passes: int, fmt: str) -> Response:
+    gray = cv2.cvtColor(decode_or_400(data), cv2.COLOR_BGR2GRAY)
+    k = (ksize | 1, ksize | 1)
+    blurred = cv2.GaussianBlur(gray, k, sigma)
+    last = cv2.Canny(blurred, low, high, L2gradient=True)
+
+    # extra passes re-run blur+Canny on the edge map, reusing the same buffers
+    out = np.empty_like(last) if passes > 1 else None
+    for _ in range(passes - 1):
+        cv2.GaussianBlur(last, k, sigma, dst=blurred)
+        cv2.Canny(blurred, low, high, edges=out, L2gradient=True)
+        if np.array_equal(out, last):
+            break  # fixed point: further passes would repeat this map
+        out, last = last, out
+
+    return array_response(last, fmt)
 
 @app.post("/images/edges")
 async def edges(
@@ -134,88 +254,91 @@ async def edges(
     sigma: float = Query(1.4, ge=0.3, le=5.0),
     low: int = Query(50, ge=0, le=255),
     high: int = Query(150, ge=0, le=255),
-    passes: int = Query(6, ge=1, le=20),
+    passes: int = Query(1, ge=1, le=20),
+    fmt: str = Query("png", pattern="^(png|webp)$"),
 ):
-    data = await file.read()
-    img_np = np.frombuffer(data, np.uint8)
-    src = cv2.imdecode(img_np, cv2.IMREAD_COLOR)
-    if src is None:
-        raise HTTPException(400, "Invalid image file")
+    data = await read_image_upload(file)
+    return await run_in_threadpool(_edges, data, ksize, sigma, low, high, passes, fmt)
 
-    gray = cv2.cvtColor(src, cv2.COLOR_BGR2GRAY)
-    edges_img = None
-    for _ in range(passes):
-        blurred = cv2.GaussianBlur(gray, (ksize | 1, ksize | 1), sigma)
-        edges_img = cv2.Canny(blurred, low, high, L2gradient=True)
-        gray = edges_img
+# === Job-based endpoint (with logging) ===
+# raster formats only; image/svg+xml and friends are rejected
+ALLOWED_IMAGE_TYPES = frozenset({"image/png", "image/jpeg", "image/webp", "image/gif"})
+
+def _process_upload(data: bytes, op: str, processed_path: str) -> tuple[int, int]:
+    gray = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        # older OpenCV builds can't read GIF; Pillow can
+        try:
+            gray = np.asarray(Image.open(BytesIO(data)).convert("L"))
+        except (UnidentifiedImageError, OSError):
+            raise ValueError("Invalid image file") from None
+    h, w = gray.shape
+    out, params = apply_op(gray, op)
+    if not cv2.imwrite(processed_path, out, params):
+        raise OSError(f"could not write {processed_path}")
+    return w, h
+
+def _process_job(job_id: str, data: bytes, op: str) -> tuple[str, dict]:
+    with SessionLocal() as db:
+        job = db.get(ImageJob, job_id)
+        try:
+            processed_path = os.path.join(PROCESSED, f"{job_id}.png")
+            w, h = _process_upload(data, op, processed_path)
+            job.processed_path = processed_path
+            job.width, job.height = w, h
+            job.status = JobStatus.done
+            action, details = op, {"width": w, "height": h}
+        except Exception as e:
+            job.status = JobStatus.error
+            job.error_message = str(e)
+            action, details = "error", {"error": str(e)}
+        db.commit()
+    return action, details
 
-    pil_img = Image.fromarray(edges_img)
-    return to_stream(pil_img, "PNG")
+async def _run_job(job_id: str, user_id: str, data: bytes, op: str):
+    # runs after the 202 has been sent; log_action has to stay on the event loop
+    action, details = await run_in_threadpool(_process_job, job_id, data, op)
+    log_action(user_id=user_id, job_id=job_id, action=action, details=details)
 
-# === Job-based endpoint (with logging) ===
-@app.post("/images/jobs")
+@app.post("/images/jobs", status_code=202)
 async def create_job(
+    background_tasks: BackgroundTasks,
     file: UploadFile = File(...),
     op: str = Query("grayscale", pattern="^(grayscale|edge)$"),
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    if not file.content_type.startswith("image/"):
-        raise HTTPException(415, "Only image/* uploads are supported")
+    if file.content_type not in ALLOWED_IMAGE_TYPES:
+        raise HTTPException(415, "Only PNG, JPEG, WebP or GIF uploads are supported")
 
+    data = await read_image_upload(file)
     original_path = os.path.join(UPLOADS, file.filename)
-    with open(original_path, "wb") as f:
-        shutil.copyfileobj(file.file, f)
+    # write the original in a worker while the job row is inserted
+    write = asyncio.ensure_future(run_in_threadpool(write_bytes, original_path, data))
 
+    # id generated here rather than on flush, so no refresh is needed after commit
+    job_id = str(uuid.uuid4())
     job = ImageJob(
+        id=job_id,
         user_id=user.username,
         original_path=original_path,
         mime_type=file.content_type,
         params={"op": op},
         status=JobStatus.processing,
     )
-    db.add(job); db.commit(); db.refresh(job)
+    db.add(job); db.commit()
 
     try:
-        im = Image.open(original_path).convert("RGB")
-        w, h = im.size
-        if op == "grayscale":
-            out = im.convert("L")
-        else:
-            out = im.convert("L").filter(ImageFilter.FIND_EDGES)
-
-        processed_path = os.path.join(PROCESSED, f"{job.id}.png")
-        out.save(processed_path)
-
-        job.processed_path = processed_path
-        job.width, job.height = w, h
-        job.status = JobStatus.done
-        db.commit()
-
-        log_action(
-            db=db,
-            user_id=user.username,
-            job_id=job.id,
-            action=op,
-            details={"width": job.width, "height": job.height}
-        )
-
-    except Exception as e:
+        await write
+    except OSError as e:
         job.status = JobStatus.error
         job.error_message = str(e)
         db.commit()
+        raise HTTPException(500, f"Could not store upload: {e}")
 
-        log_action(
-            db=db,
-            user_id=user.username,
-            job_id=job.id,
-            action="error",
-            details={"error": str(e)}
-        )
-
-        raise HTTPException(500, f"Processing failed: {e}")
-
-    return {"job_id": job.id, "status": job.status, "mime_type": job.mime_type}
+    # clients poll /images/{job_id}/meta for the result
+    background_tasks.add_task(_run_job, job_id, user.username, data, op)
+    return {"job_id": job_id, "status": JobStatus.processing, "mime_type": file.content_type}
 
 # === Read-only admin logs endpoint ===
 @app.get("/admin/logs")
@@ -242,15 +365,24 @@ def admin_logs(
     ]
 
 # === CPU intensive endpoint ===
+def _sha256_chain(x: bytes, iters: int) -> bytes:
+    # each round depends on the previous digest, so the chain can't be batched;
+    # keep the loop tight by binding the OpenSSL constructor locally.
+    # hashlib.sha256 is OpenSSL's EVP SHA-256 (see hmac_backend() in the startup
+    # log), which uses the SHA-NI / ARMv8 SHA2 compress path where the CPU has
+    # it, so cycles/s here varies with the host CPU, not just its clock.
+    sha256 = hashlib.sha256
+    for _ in range(iters):
+        x = sha256(x).digest()
+    return x
+
 @app.get("/cpu-burn")
 def cpu_burn(ms: int = 250, iters: int = 60000):
-    end = time.time() + ms/1000.0
+    end = time.monotonic() + ms/1000.0
     payload = secrets.token_bytes(1024)
     n = 0
-    while time.time() < end:
-        x = payload
-        for _ in range(iters):
-            x = hashlib.sha256(x).digest()
+    while time.monotonic() < end:
+        _sha256_chain(payload, iters)
         n += 1
     return {"ok": True, "cycles": n, "pid": os.getpid()}
 
@@ -264,43 +396,78 @@ def admin_ping(user: User = Depends(require_role("admin"))):
     return {"ok": True, "msg": "admin only"}
 
 # --- Jobs: meta & file download ---
+def _get_user_job(db: Session, job_id: str, user: User) -> ImageJob:
+    # ids are stored as 16-byte UUIDs; anything that doesn't parse can't exist
+    try:
+        uuid.UUID(job_id)
+    except ValueError:
+        raise HTTPException(status_code=404, detail="Not Found")
+    job = db.get(ImageJob, job_id)
+    if not job or job.user_id != user.username:
+        raise HTTPException(status_code=404, detail="Not Found")
+    return job
+
 @app.get("/images/{job_id}/meta")
 def get_meta(
     job_id: str,
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    job = db.get(ImageJob, job_id)
-    if not job or job.user_id != user.username:
-        raise HTTPException(status_code=404, detail="Not Found")
-    return {
+    job = _get_user_job(db, job_id, user)
+    # returned as a response directly so orjson formats created_at (and the
+    # status enum) in C, skipping FastAPI's Python-level jsonable_encoder pass
+    return ORJSONResponse({
         "job_id": job.id,
         "status": job.status,
         "mime_type": job.mime_type,
         "params": job.params,
         "width": job.width,
         "height": job.height,
-        "created_at": job.created_at.isoformat() if job.created_at else None,
+        "created_at": job.created_at,
         "original_path": job.original_path if job.status == JobStatus.done else None,
         "processed_path": job.processed_path if job.status == JobStatus.done else None,
         "error_message": job.error_message,
-    }
+    })
+
+def _etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    # If-None-Match uses weak comparison (RFC 9110 13.1.2): W/"x" matches "x",
+    # and * matches any current representation
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        if tag == "*" or tag.removeprefix("W/") == etag:
+            return True
+    return False
 
 @app.get("/images/{job_id}/file")
 def get_file(
     job_id: str,
+    request: Request,
     kind: str = Query("processed", pattern="^(processed|original)$"),
     user: User = Depends(get_current_user),
     db: Session = Depends(get_db),
 ):
-    job = db.get(ImageJob, job_id)
-    if not job or job.user_id != user.username:
-        raise HTTPException(status_code=404, detail="Not Found")
+    job = _get_user_job(db, job_id, user)
+    if kind == "processed" and job.status != JobStatus.done:
+        # jobs are processed after the 202; poll /meta until status is done
+        if job.status == JobStatus.error:
+            raise HTTPException(status_code=409, detail="job failed")
+        raise HTTPException(status_code=409, detail="job still processing")
     path = job.processed_path if kind == "processed" else job.original_path
-    if not path or not os.path.exists(path):
+    try:
+        st = os.stat(path) if path else None
+    except FileNotFoundError:
+        st = None
+    if st is None:
         raise HTTPException(status_code=404, detail="file missing")
+    # repeat downloads revalidate with If-None-Match and get a 304 instead of the file
+    etag = f'"{job.id}-{kind}-{int(st.st_mtime)}-{st.st_size}"'
+    headers = {"ETag": etag, "Cache-Control": "private, max-age=60"}
+    if _etag_matches(request.headers.get("if-none-match"), etag):
+        return Response(status_code=304, headers=headers)
     media_type = job.mime_type if kind == "original" else "image/png"
-    return FileResponse(path, media_type=media_type)
+    return FileResponse(path, media_type=media_type, headers=headers, stat_result=st)
 
 # --- My logs (auth required, non-admin) ---
 @app.get("/logs/mine")
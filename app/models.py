@@ -2,13 +2,40 @@
 from sqlalchemy import (
     Column, String, Integer, DateTime, JSON, Enum, ForeignKey, func, Index
 )
+from sqlalchemy.dialects import postgresql
 from sqlalchemy.orm import relationship
+from sqlalchemy.types import BINARY, TypeDecorator
 from app.db import Base
 import enum
 from datetime import datetime
 import uuid
 
 
+# ----- Types -----
+class BinaryUUID(TypeDecorator):
+    """UUID stored in 16 bytes (native uuid on PostgreSQL, BINARY(16) elsewhere).
+
+    Python code keeps using the canonical hyphenated string.
+    """
+    impl = BINARY(16)
+    cache_ok = True
+
+    def load_dialect_impl(self, dialect):
+        if dialect.name == "postgresql":
+            return dialect.type_descriptor(postgresql.UUID(as_uuid=False))
+        return dialect.type_descriptor(BINARY(16))
+
+    def process_bind_param(self, value, dialect):
+        if value is None or dialect.name == "postgresql":
+            return value
+        return uuid.UUID(str(value)).bytes
+
+    def process_result_value(self, value, dialect):
+        if value is None or dialect.name == "postgresql":
+            return value
+        return str(uuid.UUID(bytes=bytes(value)))
+
+
 # ----- Enums -----
 class JobStatus(str, enum.Enum):
     processing = "processing"
@@ -20,8 +47,8 @@ class JobStatus(str, enum.Enum):
 class ImageJob(Base):
     __tablename__ = "image_jobs"
 
-    # UUID stored as string for portability
-    id = Column(String, primary_key=True, default=lambda: str(uuid.uuid4()))
+    # UUID, exposed as a string but stored in 16 bytes (smaller PK and indexes)
+    id = Column(BinaryUUID, primary_key=True, default=lambda: str(uuid.uuid4()))
 
     # Keep user_id as String to match your existing code/auth layer
     user_id = Column(String, nullable=False)
@@ -48,6 +75,11 @@ class ImageJob(Base):
 # Optional: a helpful index for recent jobs
 Index("ix_image_jobs_created_at", ImageJob.created_at)
 
+# per-user listings filter on user_id and order newest first; the leading
+# user_id column also serves plain user_id lookups, so no separate index
+Index("ix_image_jobs_user_created", ImageJob.user_id, ImageJob.created_at.desc())
+Index("ix_image_jobs_status", ImageJob.status)
+
 
 # ----- Additional data type: Processing logs/history -----
 class ProcessingLog(Base):
@@ -59,7 +91,7 @@ class ProcessingLog(Base):
     user_id = Column(String, nullable=False)
 
     # Link logs directly to the job they describe
-    job_id = Column(String, ForeignKey("image_jobs.id", ondelete="CASCADE"), nullable=False)
+    job_id = Column(BinaryUUID, ForeignKey("image_jobs.id", ondelete="CASCADE"), nullable=False)
 
     # e.g. "upload", "grayscale", "edge_detect", "resize", "error"
     action = Column(String, nullable=False)
@@ -76,4 +108,8 @@ class ProcessingLog(Base):
 
 # Optional: index for faster admin queries by time or action
 Index("ix_processing_logs_timestamp", ProcessingLog.timestamp)
-Index("ix_processing_logs_action", ProcessingLog.action)
+
+# /logs/mine and /admin/logs?action=... filter on one column and order by newest
+# first; these let SQLite walk the index instead of scanning and sorting
+Index("ix_processing_logs_user_timestamp", ProcessingLog.user_id, ProcessingLog.timestamp.desc())
+Index("ix_processing_logs_action_timestamp", ProcessingLog.action, ProcessingLog.timestamp.desc())
@@ -1,66 +1,75 @@
 # app/routers/external.py
-from fastapi import APIRouter, Query, HTTPException, Depends
-from fastapi.responses import StreamingResponse
+from fastapi import APIRouter, Query, HTTPException, Depends, Request
+from fastapi.concurrency import run_in_threadpool
+from collections import OrderedDict
 from typing import Optional
 import urllib.parse
 import os, uuid, asyncio
 from io import BytesIO
-from PIL import Image, ImageFilter
+from PIL import Image
+import numpy as np, cv2
 import httpx
 
 from app.auth import get_current_user, User
-from app.db import SessionLocal
+from app.common import get_db, write_bytes, apply_op, image_response, UPLOADS, PROCESSED
 from sqlalchemy.orm import Session
 from app.models import ImageJob, JobStatus
 
 router = APIRouter(prefix="/external", tags=["external"])
 
-DATA_DIR = os.getenv("DATA_DIR", "/data")
-UPLOADS = os.path.join(DATA_DIR, "uploads")
-PROCESSED = os.path.join(DATA_DIR, "processed")
-
-os.makedirs(UPLOADS, exist_ok=True)
-os.makedirs(PROCESSED, exist_ok=True)
-
-def get_db():
-    db = SessionLocal()
-    try:
-        yield db
-    finally:
-        db.close()
-
-def to_stream(img: Image.Image, fmt: str = "PNG") -> StreamingResponse:
-    buf = BytesIO()
-    img.save(buf, format=fmt)
-    buf.seek(0)
-    mt = "image/png" if fmt.upper() == "PNG" else "image/jpeg"
-    return StreamingResponse(buf, media_type=mt,
-                             headers={"Content-Disposition": 'inline; filename="output.png"'})
-
-async def _get_with_retries(url: str, *, follow_redirects: bool = True, timeout: float = 20.0, attempts: int = 3) -> httpx.Response:
-    async with httpx.AsyncClient(follow_redirects=follow_redirects, timeout=timeout) as client:
-        last_exc = None
-        for i in range(1, attempts + 1):
-            try:
-                r = await client.get(url)
-                if r.status_code == 200:
-                    return r
-                # retry on 429/5xx
-                if r.status_code in (429, 500, 502, 503, 504):
-                    await asyncio.sleep(0.6 * i)
-                    continue
-                # other non-200: no retry
-                raise HTTPException(502, f"External API HTTP {r.status_code}")
-            except (httpx.ReadTimeout, httpx.ConnectError) as e:
-                last_exc = e
+# QR codes are deterministic in (text, size), so the rendered PNG is cached by
+# request URL; picsum returns a different image each call and is not cached
+QR_CACHE_SIZE = 512
+_qr_cache: "OrderedDict[str, bytes]" = OrderedDict()
+
+def _process_random(content: bytes, op: Optional[str], job_id: str):
+    if op is None:
+        # nothing to apply: store and serve the fetched JPEG bytes as they are;
+        # Image.open only parses the header here, it doesn't decode pixels
+        processed_path = os.path.join(PROCESSED, f"{job_id}.jpg")
+        write_bytes(processed_path, content)
+        return content, "image/jpeg", processed_path, Image.open(BytesIO(content)).size
+
+    gray = cv2.imdecode(np.frombuffer(content, np.uint8), cv2.IMREAD_GRAYSCALE)
+    if gray is None:
+        raise HTTPException(502, "External API returned an undecodable image")
+    out, params = apply_op(gray, op)
+
+    ok, enc = cv2.imencode(".png", out, params)
+    if not ok:
+        raise HTTPException(500, "Image encode failed")
+    data = enc.tobytes()
+    processed_path = os.path.join(PROCESSED, f"{job_id}.png")
+    write_bytes(processed_path, data)
+    h, w = out.shape[:2]
+    return data, "image/png", processed_path, (w, h)
+
+async def _get_with_retries(client: httpx.AsyncClient, url: str, *, follow_redirects: bool = True, timeout: float = 20.0, attempts: int = 3) -> httpx.Response:
+    # client is the app-wide pooled one (app.state.http), so keep-alive
+    # connections to each host are reused across requests
+    last_exc = None
+    for i in range(1, attempts + 1):
+        try:
+            r = await client.get(url, follow_redirects=follow_redirects, timeout=timeout)
+            if r.status_code == 200:
+                return r
+            # retry on 429/5xx
+            if r.status_code in (429, 500, 502, 503, 504):
                 await asyncio.sleep(0.6 * i)
-        # exhausted
-        if last_exc:
-            raise HTTPException(502, f"External API network error: {last_exc}")
-        raise HTTPException(502, "External API failed after retries")
+                continue
+            # other non-200: no retry
+            raise HTTPException(502, f"External API HTTP {r.status_code}")
+        except (httpx.ReadTimeout, httpx.ConnectError) as e:
+            last_exc = e
+            await asyncio.sleep(0.6 * i)
+    # exhausted
+    if last_exc:
+        raise HTTPException(502, f"External API network error: {last_exc}")
+    raise HTTPException(502, "External API failed after retries")
 
 @router.get("/random")
 async def fetch_random_image(
+    request: Request,
     w: int = Query(512, ge=16, le=4096),
     h: int = Query(512, ge=16, le=4096),
     op: Optional[str] = Query(None, pattern="^(grayscale|edge)$"),
@@ -71,50 +80,49 @@ async def fetch_random_image(
     Pull a random image from Picsum, optionally process, save job, return image.
     """
     url = f"https://picsum.photos/{w}/{h}"
-    r = await _get_with_retries(url, follow_redirects=True)
+    r = await _get_with_retries(request.app.state.http, url, follow_redirects=True)
 
     # simple content-type sanity check
     ctype = r.headers.get("content-type", "")
     if "image" not in ctype:
         raise HTTPException(502, f"External API returned non-image ({ctype})")
 
-    # save original
+    # save original while the job row is created and the image processed
     original_path = os.path.join(UPLOADS, f"ext_{uuid.uuid4().hex}.jpg")
-    with open(original_path, "wb") as f:
-        f.write(r.content)
+    write = asyncio.ensure_future(run_in_threadpool(write_bytes, original_path, r.content))
 
-    # create job
+    # the id is generated here so the output can be named before the row is
+    # written; the job is then inserted once, with its final status
     job = ImageJob(
+        id=str(uuid.uuid4()),
         user_id=user.username,
         original_path=original_path,
         mime_type="image/jpeg",
         params={"source": "picsum", "op": op},
-        status=JobStatus.processing,
     )
-    db.add(job); db.commit(); db.refresh(job)
-
-    # process (optional)
-    im = Image.open(BytesIO(r.content)).convert("RGB")
-    if op == "grayscale":
-        out = im.convert("L"); fmt = "PNG"
-    elif op == "edge":
-        out = im.convert("L").filter(ImageFilter.FIND_EDGES); fmt = "PNG"
-    else:
-        out = im; fmt = "JPEG"
 
-    processed_path = os.path.join(PROCESSED, f"{job.id}.png" if fmt == "PNG" else f"{job.id}.jpg")
-    out.save(processed_path)
+    # process (optional); decode/filter/encode is blocking, so off the event loop
+    try:
+        data, media_type, processed_path, (width, height) = await run_in_threadpool(
+            _process_random, r.content, op, job.id
+        )
+        await write
+    except (HTTPException, OSError) as e:
+        job.status = JobStatus.error
+        job.error_message = str(getattr(e, "detail", e))
+        db.add(job); db.commit()
+        raise
 
-    # update job
     job.processed_path = processed_path
     job.status = JobStatus.done
-    job.width, job.height = out.size
-    db.commit()
+    job.width, job.height = width, height
+    db.add(job); db.commit()
 
-    return to_stream(out, fmt)
+    return image_response(data, media_type, ".png" if media_type == "image/png" else ".jpg")
 
 @router.get("/qrcode")
 async def generate_qrcode(
+    request: Request,
     text: str = Query(..., min_length=1, max_length=2048),
     size: int = Query(256, ge=64, le=1024),
     user: User = Depends(get_current_user),
@@ -125,34 +133,41 @@ async def generate_qrcode(
     """
     enc = urllib.parse.quote_plus(text)
     url = f"https://api.qrserver.com/v1/create-qr-code/?size={size}x{size}&data={enc}"
-    r = await _get_with_retries(url, follow_redirects=True)
+    content = _qr_cache.get(url)
+    if content is not None:
+        _qr_cache.move_to_end(url)
+    else:
+        r = await _get_with_retries(request.app.state.http, url, follow_redirects=True)
 
-    ctype = r.headers.get("content-type", "")
-    if "image" not in ctype:
-        raise HTTPException(502, f"External API returned non-image ({ctype})")
+        ctype = r.headers.get("content-type", "")
+        if "image" not in ctype:
+            raise HTTPException(502, f"External API returned non-image ({ctype})")
+
+        content = r.content
+        _qr_cache[url] = content
+        while len(_qr_cache) > QR_CACHE_SIZE:
+            _qr_cache.popitem(last=False)
 
     # save original (same as processed)
     original_path = os.path.join(UPLOADS, f"qr_{uuid.uuid4().hex}.png")
-    with open(original_path, "wb") as f:
-        f.write(r.content)
+    await run_in_threadpool(write_bytes, original_path, content)
+
+    job_id = str(uuid.uuid4())
+    processed_path = os.path.join(PROCESSED, f"{job_id}.png")
+    await run_in_threadpool(write_bytes, processed_path, content)
 
     job = ImageJob(
+        id=job_id,
         user_id=user.username,
         original_path=original_path,
+        processed_path=processed_path,
         mime_type="image/png",
         params={"source": "qrserver", "text_len": len(text)},
-        status=JobStatus.processing,
+        status=JobStatus.done,
+        width=size,
+        height=size,
     )
-    db.add(job); db.commit(); db.refresh(job)
-
-    processed_path = os.path.join(PROCESSED, f"{job.id}.png")
-    with open(processed_path, "wb") as f:
-        f.write(r.content)
-
-    job.processed_path = processed_path
-    job.status = JobStatus.done
-    job.width = size; job.height = size
-    db.commit()
+    db.add(job); db.commit()
 
-    img = Image.open(BytesIO(r.content))
-    return to_stream(img, "PNG")
+    # qrserver already returns PNG; send those bytes rather than re-encoding
+    return image_response(content, "image/png", ".png")
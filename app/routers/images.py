@@ -1,8 +1,11 @@
 # app/routers/images.py
-from fastapi import APIRouter, Query, Response
+from fastapi import APIRouter, Query
+from fastapi.responses import ORJSONResponse
 from pydantic import BaseModel
 from typing import List, Optional
 from datetime import datetime
+from operator import itemgetter
+import heapq
 
 router = APIRouter(prefix="/images", tags=["images"])
 
@@ -17,9 +20,10 @@ class ImageOut(BaseModel):
 SORT_FIELDS = {"created_at", "filename", "kind", "status", "id"}
 SORT_ORDERS = {"asc", "desc"}
 
-@router.get("/", response_model=List[ImageOut])
+# ImageOut documents the schema only; rows are serialized straight from dicts
+# by orjson instead of being validated through the model one by one
+@router.get("/", responses={200: {"model": List[ImageOut]}})
 def list_images(
-    response: Response,
     # pagination (support both styles)
     limit: int = Query(10, ge=1, le=100),
     offset: int = Query(0, ge=0),
@@ -52,32 +56,31 @@ def list_images(
     # ---------- OPTION A: in-memory store (quick test) ----------
     try:
         from app.data_store import IMAGES  # <- create this in Step 3
-        data = IMAGES.copy()
+        data = IMAGES
         use_db = False
     except Exception:
         data = []
         use_db = True
 
-    items: List[ImageOut] = []
+    items: List[dict] = []
 
     if not use_db:
-        # filter
-        if owner:
-            data = [x for x in data if x["owner"] == owner]
-        if kind:
-            data = [x for x in data if x["kind"] == kind]
-        if status:
-            data = [x for x in data if x["status"] == status]
-        if created_after:
-            data = [x for x in data if x["created_at"] >= created_after]
-        if created_before:
-            data = [x for x in data if x["created_at"] <= created_before]
+        # filter in a single pass
+        data = [
+            x for x in data
+            if (not owner or x["owner"] == owner)
+            and (not kind or x["kind"] == kind)
+            and (not status or x["status"] == status)
+            and (not created_after or x["created_at"] >= created_after)
+            and (not created_before or x["created_at"] <= created_before)
+        ]
 
         total = len(data)
-        reverse = (order == "desc")
-        data.sort(key=lambda x: x[sort_by], reverse=reverse)
-        page_items = data[offset: offset + limit]
-        items = [ImageOut(**it) for it in page_items]
+        # only the first offset+limit rows are ever returned, so take the top-K
+        # instead of sorting everything (same order/ties as a stable sort)
+        top = heapq.nlargest if order == "desc" else heapq.nsmallest
+        page_items = top(offset + limit, data, key=itemgetter(sort_by))[offset:]
+        items = page_items
 
     else:
         # ---------- OPTION B: SQLAlchemy (flip to real DB) ----------
@@ -95,15 +98,15 @@ def list_images(
         #     q = q.order_by(sort_col.asc() if order == "asc" else sort_col.desc())
         #     rows = q.offset(offset).limit(limit).all()
         #     items = [
-        #         ImageOut(
-        #             id=r.id, owner=r.owner, filename=r.filename,
-        #             kind=r.kind, status=r.status, created_at=r.created_at
-        #         ) for r in rows
+        #         {
+        #             "id": r.id, "owner": r.owner, "filename": r.filename,
+        #             "kind": r.kind, "status": r.status, "created_at": r.created_at,
+        #         } for r in rows
         #     ]
         total = 0  # placeholder if DB not wired
 
     # headers: total + RFC5988 pagination links
-    response.headers["X-Total-Count"] = str(total)
+    headers = {"X-Total-Count": str(total)}
 
     def build_link(off, lim):
         qs = []
@@ -129,5 +132,5 @@ def list_images(
         last_page_off = ((total - 1) // limit) * limit
         links.append(build_link(last_page_off, limit) + '; rel="last"')
 
-    response.headers["Link"] = ", ".join(links)
-    return items
+    headers["Link"] = ", ".join(links)
+    return ORJSONResponse(items, headers=headers)